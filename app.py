@@ -1,10 +1,27 @@
 import streamlit as st
+import bisect
+import copy
 import docx
+import hashlib
+import html
 import os
 import io
+import itertools
+import json
 import re
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape as xml_escape
+from docx.oxml import OxmlElement
+from docx.text.paragraph import Paragraph
 from dotenv import load_dotenv
-from openai import OpenAI  # We use the OpenAI library to call Cohere
+from lxml import etree
+from openai import DefaultHttpxClient, OpenAI  # We use the OpenAI library to call Cohere
+
+try:
+    import re2  # google-re2: linear-time (DFA) matching, no backtracking
+except ImportError:
+    re2 = None
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -14,7 +31,28 @@ st.set_page_config(
 )
 
 # --- Environment Variable & API Key ---
-load_dotenv()
+# Streamlit reruns this script on every interaction, so the .env read and the
+# client (with its HTTP connection pool) are created once per process.
+@st.cache_resource(show_spinner=False)
+def _load_env():
+    """Loads .env into os.environ once per process."""
+    load_dotenv()
+
+@st.cache_resource(show_spinner=False)
+def _get_client(api_key):
+    """Builds the Cohere-compatible OpenAI client once per API key."""
+    # --- CONFIGURE OPENAI CLIENT FOR COHERE ---
+    # This setup points the standard OpenAI library to Cohere's API
+    return OpenAI(
+        api_key=api_key,
+        # This is the CORRECT URL to fix the 405 error
+        base_url="https://api.cohere.ai/compatibility/v1",
+        # Keeps the SDK's pool limits and timeouts; HTTP/2 lets the concurrent
+        # question requests share one TLS connection instead of opening one each.
+        http_client=DefaultHttpxClient(http2=True)
+    )
+
+_load_env()
 COHERE_API_KEY = os.getenv("COHERE_API_KEY")
 
 # Check for API key
@@ -23,102 +61,519 @@ if not COHERE_API_KEY:
     st.stop()
 
 try:
-    # --- CONFIGURE OPENAI CLIENT FOR COHERE ---
-    # This setup points the standard OpenAI library to Cohere's API
-    client = OpenAI(
-        api_key=COHERE_API_KEY,
-        # This is the CORRECT URL to fix the 405 error
-        base_url="https://api.cohere.ai/compatibility/v1" 
-    )
+    client = _get_client(COHERE_API_KEY)
     COHERE_MODEL = "command-r-plus-08-2024" # <-- Use the new flagship model  # Use a powerful Cohere model
-    # --- END CLIENT CONFIGURATION ---
 except Exception as e:
     st.error(f"Failed to configure Cohere-compatible client: {e}")
     st.stop()
 
 # --- Helper Functions ---
 
-def extract_text_and_placeholders(file_bytes):
+def _compile_placeholder_re(pattern):
+    """Compiles with google-re2 when it is installed and accepts the pattern, else falls back to `re`."""
+    if re2 is not None:
+        try:
+            return re2.compile(pattern)
+        except re2.error:
+            pass
+    return re.compile(pattern)
+
+# Covers: {placeholder}, {{placeholder}}, [placeholder], <placeholder>, %placeholder%, __placeholder__, $placeholder
+# Compiled once at import so every upload reuses the same pattern object.
+# Negated classes keep each match inside one pair of delimiters on one line: "[a [b]" yields "[b]".
+# Names are 1-128 characters, so a stray opening delimiter rescans at most 128 characters
+# under `re` (empty pairs like "[]" are not placeholders). Underscores aren't a bracket pair:
+# their run may be empty, so a "____" blank matches on its own instead of swallowing the
+# text up to the next blank (at most 128 characters in all).
+# The single group around the whole pattern makes `split` keep the placeholders it splits on
+# (findall still returns the full matches).
+_PLACEHOLDER_RE = _compile_placeholder_re(
+    r"(\{{1,2}[^{}\n]{1,128}\}{1,2}|\[[^\[\]\n]{1,128}\]|<[^<>\n]{1,128}>|%[^%\n]{1,128}%"
+    r"|__[^\n]{0,124}?__|\$[a-zA-Z0-9_]+)"
+)
+
+def _doc_digest(file_bytes):
+    """SHA-256 of the uploaded bytes, used as the cache key for parsed/filled documents."""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+# WordprocessingML tags the read-only text scan cares about.
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_P, _W_R, _W_T, _W_TAB, _W_BR, _W_CR = (_W + tag for tag in ("p", "r", "t", "tab", "br", "cr"))
+
+def _iter_paragraph_texts(document_xml):
+    """
+    Yields the text of each <w:p> in `document_xml`, in document order, by streaming it with
+    lxml iterparse instead of building python-docx objects.
+    """
+    open_paragraphs = [] # Text pieces of each <w:p> still open (text boxes can nest them)
+    for event, el in etree.iterparse(
+        io.BytesIO(document_xml), events=("start", "end"), tag=(_W_P, _W_T, _W_TAB, _W_BR, _W_CR)
+    ):
+        if el.tag == _W_P:
+            if event == "start":
+                open_paragraphs.append([])
+                continue
+            yield "".join(open_paragraphs.pop())
+            # Drop fully processed siblings too, so memory stays flat however long the document is.
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+        elif event == "start" or not open_paragraphs:
+            continue
+        elif el.tag == _W_T:
+            if el.text:
+                open_paragraphs[-1].append(el.text)
+        elif el.getparent().tag != _W_R:
+            continue # e.g. <w:tab> tab-stop definitions inside <w:pPr>
+        elif el.tag == _W_TAB:
+            open_paragraphs[-1].append("\t")
+        else:
+            open_paragraphs[-1].append("\n")
+        el.clear() # Keep the partially built tree small
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _parse_docx(digest, _file_bytes):
+    """
+    Parses the .docx and returns (text, placeholders).
+    Cached on `digest`, so re-uploading the same template skips the parse entirely.
+    """
+    with zipfile.ZipFile(io.BytesIO(_file_bytes)) as z:
+        document_xml = z.read("word/document.xml")
+    
+    full_text_str = "\n".join(_iter_paragraph_texts(document_xml))
+    # No alternative can match across "\n", so one scan of the joined text finds
+    # exactly what a scan per paragraph would, in a single engine call.
+    # dict.fromkeys dedupes while keeping the order of first appearance.
+    placeholders = list(dict.fromkeys(_PLACEHOLDER_RE.findall(full_text_str)))
+    
+    return full_text_str, placeholders
+
+def extract_text_and_placeholders(file_bytes, digest=None):
     """
     Extracts text and unique placeholders from a .docx file.
     This regex is much more robust and covers most common syntaxes.
+    `digest` is the file's `_doc_digest`, when already known.
     """
     try:
-        doc = docx.Document(io.BytesIO(file_bytes))
-        full_text = []
-        for para in doc.paragraphs:
-            full_text.append(para.text)
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    for para in cell.paragraphs:
-                        full_text.append(para.text)
-        
-        full_text_str = "\n".join(full_text)
-        
-        # --- ROBUST REGEX ---
-        # Covers: {placeholder}, {{placeholder}}, [placeholder], <placeholder>, %placeholder%, __placeholder__, $placeholder
-        placeholder_regex = r"\{{1,2}.*?\}{1,2}|\[.*?\]|<.*?>|%.*?%|__.*?__|\$[a-zA-Z0-9_]+"
-        
-        placeholders = list(set(re.findall(placeholder_regex, full_text_str))) # Unique list
-        
-        return full_text_str, placeholders
+        return _parse_docx(digest or _doc_digest(file_bytes), file_bytes)
     except Exception as e:
         st.error(f"Error reading .docx file: {e}")
         return None, []
 
-def replace_placeholders_in_doc(file_bytes, replacements):
+def iter_paragraphs(doc):
+    """
+    Yields every paragraph of a python-docx Document that the fill covers: those of the body
+    (including nested tables) and of each header and footer part, the same parts
+    `_fill_docx_xml` rewrites. One XPath query per part instead of walking tables, rows and cells.
+    """
+    for part in doc.part.package.iter_parts():
+        if _TEXT_PART_RE.fullmatch(part.partname.lstrip("/")):
+            for p in part.element.xpath(".//w:p"):
+                yield Paragraph(p, doc)
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _load_template(digest, _file_bytes):
+    """
+    Parses the uploaded template once per process. Shared across reruns and sessions,
+    so callers must deep-copy it before making changes.
+    """
+    return docx.Document(io.BytesIO(_file_bytes))
+
+# Parts whose text both fill paths cover: the zip entries the fast path rewrites in place,
+# and the package parts `iter_paragraphs` walks for the python-docx fallback.
+_TEXT_PART_RE = re.compile(r"word/(document|header\d*|footer\d*)\.xml")
+_W_NS_DECL = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+_W_T_RE = re.compile(r"(<w:t(?:\s[^>]*)?>)([^<]*)(</w:t>)")
+
+def _key_starts(keys):
+    """
+    The distinct first characters of `keys`. Text containing none of them holds no key, and a few
+    `in` checks (memchr in C) reject plain prose faster than running the alternation over it.
+    """
+    return "".join(dict.fromkeys(key[0] for key in keys))
+
+def _fill_docx_xml(file_bytes, replacements):
+    """
+    Fast fill path: substitutes the keys inside the <w:t> text of the document, header and footer
+    XML and copies every other zip entry through untouched, with no python-docx round-trip.
+    Returns None when python-docx has to do it instead: a key split across runs, a key or value
+    with control characters (tabs and line breaks are run markup), or XML this path doesn't expect.
+    """
+    if not replacements:
+        return file_bytes
+    # Tabs and line breaks are run markup (<w:tab/>, <w:br/>), not <w:t> text: a value holding one
+    # needs that markup, and a key holding one (e.g. "____\tDate: ____") can't be found in <w:t> text.
+    if any(ch < " " for text in itertools.chain(replacements, replacements.values()) for ch in text):
+        return None
+    # Text nodes hold XML-escaped text, so match and insert escaped strings.
+    escaped = {xml_escape(k): xml_escape(v) for k, v in replacements.items()}
+    pattern = re.compile("|".join(map(re.escape, sorted(escaped, key=len, reverse=True))))
+    starts = _key_starts(escaped)
+    
+    def lookup(m):
+        return escaped[m.group(0)]
+    
+    def fill_text_node(m):
+        text = m.group(2)
+        if not any(c in text for c in starts):
+            return m.group(0)
+        new_text = pattern.sub(lookup, text)
+        if new_text is text:
+            return m.group(0)
+        open_tag = m.group(1)
+        if new_text != new_text.strip() and "xml:space" not in open_tag:
+            open_tag = open_tag[:-1] + ' xml:space="preserve">' # Word trims edge spaces otherwise
+        return open_tag + new_text + m.group(3)
+    
+    out = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(file_bytes)) as zin, zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zout:
+        for item in zin.infolist():
+            data = zin.read(item)
+            if _TEXT_PART_RE.fullmatch(item.filename):
+                xml = data.decode("utf-8")
+                if _W_NS_DECL not in xml:
+                    return None
+                xml = _W_T_RE.sub(fill_text_node, xml)
+                # Any key still visible in the text was split across runs (or written differently).
+                remaining = html.unescape("".join(m.group(2) for m in _W_T_RE.finditer(xml)))
+                if any(key in remaining for key in replacements):
+                    return None
+                data = xml.encode("utf-8")
+            zout.writestr(item, data)
+    return out.getvalue()
+
+_XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+
+def _run_text_children(runs):
+    """
+    The children of `runs` that make up their `.text` (<w:t>, tabs, line breaks...), in document
+    order, each with its text. Page breaks, pictures and fields add no text and aren't listed.
+    """
+    children = []
+    for run in runs:
+        for e in run._r.xpath("w:br | w:cr | w:noBreakHyphen | w:ptab | w:t | w:tab"):
+            text = str(e)
+            if text:
+                children.append((e, text))
+    return children
+
+def _set_text(t, text):
+    """
+    Sets the text of the <w:t> element `t` in place, so everything around it stays where it is.
+    Tabs and line breaks in `text` become <w:tab/>/<w:br/> elements standing where `t` was.
+    """
+    if not any(ch < " " for ch in text):
+        t.text = text
+        if text != text.strip():
+            t.set(_XML_SPACE, "preserve") # Word trims edge spaces otherwise
+        return
+    scratch = OxmlElement("w:r")
+    scratch.text = text # Builds the <w:t>/<w:tab>/<w:br> sequence for `text`
+    for e in list(scratch):
+        t.addprevious(e)
+    t.getparent().remove(t)
+
+def _fill_paragraph(runs, pattern, replacements, starts):
+    """
+    Substitutes the keys in one paragraph's runs. Matches are found on the joined run text, so a key
+    Word split across runs (e.g. "{Clie" + "ntName}") is still found, and one key containing another
+    can't be mistaken for it. A match's value goes into the <w:t> its first character is in; the rest
+    of its text is removed from the elements after it, and text after the match stays in its own
+    element. Only text elements change: formatting, pictures, fields and breaks keep their place.
+    `starts` is `_key_starts` of the keys, for skipping paragraphs that can't hold one.
+    """
+    children = _run_text_children(runs)
+    combined = "".join(text for _, text in children)
+    if not any(c in combined for c in starts):
+        return
+    spans = [m.span() for m in pattern.finditer(combined)]
+    if not spans:
+        return
+    # Child i holds combined[bounds[i]:bounds[i + 1]].
+    bounds = list(itertools.accumulate((len(text) for _, text in children), initial=0))
+    # Matches grouped by the children they cover: [first child, last child, spans]. Groups sharing one merge.
+    # Keys start and end with a printable character, so a group's first and last children are <w:t>s.
+    groups = []
+    for start, end in spans:
+        first = bisect.bisect_right(bounds, start) - 1
+        last = bisect.bisect_right(bounds, end - 1) - 1
+        if groups and first <= groups[-1][1]:
+            groups[-1][1] = last
+            groups[-1][2].append((start, end))
+        else:
+            groups.append([first, last, [(start, end)]])
+    for first, last, group_spans in groups:
+        pieces, pos = [], bounds[first]
+        for start, end in group_spans:
+            pieces += combined[pos:start], replacements[combined[start:end]]
+            pos = end
+        if first == last:
+            pieces.append(combined[pos:bounds[last + 1]])
+        else:
+            _set_text(children[last][0], combined[pos:bounds[last + 1]])
+            for e, _ in children[first + 1:last]:
+                if e.tag == _W_T:
+                    e.text = ""
+                else:
+                    e.getparent().remove(e) # A tab or break inside the key goes with it
+        _set_text(children[first][0], "".join(pieces))
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _fill_docx(digest, _file_bytes, replacement_items):
+    """
+    Builds the filled .docx bytes. Cached on (`digest`, sorted replacement items),
+    so an unchanged set of answers returns the previous result without re-parsing.
+    A resource cache hands back the same immutable bytes object on every rerun,
+    where `st.cache_data` would unpickle a fresh copy of the whole document each time.
+    """
+    replacements = dict(replacement_items) # Values are str: chat answers are stored as typed
+    filled = _fill_docx_xml(_file_bytes, replacements)
+    if filled is not None:
+        return filled
+    
+    doc = copy.deepcopy(_load_template(digest, _file_bytes))
+    if replacements:
+        # One alternation over every key: each paragraph is scanned once, not once per key.
+        # Longest keys first, so a key that is a prefix of another can't win the match.
+        keys_sorted = sorted(replacements, key=len, reverse=True)
+        pattern = re.compile("|".join(map(re.escape, keys_sorted)))
+        starts = _key_starts(keys_sorted)
+        
+        for p in iter_paragraphs(doc):
+            _fill_paragraph(p.runs, pattern, replacements, starts)
+    file_stream = io.BytesIO()
+    doc.save(file_stream)
+    return file_stream.getvalue() # Hands over the stream's buffer; no copy is made
+
+def _fill_args(file_bytes, replacements, original_text=None, digest=None):
+    """
+    Returns the `_fill_docx` arguments for this fill, or None when there is nothing to replace.
+    If `original_text` (the extracted document text) is given, keys that never occur in it are dropped.
+    `digest` is the file's `_doc_digest`, when already known; otherwise the bytes are hashed here.
+    """
+    if original_text is not None:
+        replacements = {k: v for k, v in replacements.items() if k in original_text}
+    if not replacements:
+        return None
+    return digest or _doc_digest(file_bytes), file_bytes, tuple(sorted(replacements.items()))
+
+def replace_placeholders_in_doc(file_bytes, replacements, original_text=None, digest=None):
     """
     Replaces placeholders in a docx file (in memory) and returns the new file bytes.
     This function replaces text while attempting to preserve formatting by operating on runs.
+    If `original_text` (the extracted document text) is given, keys that never occur in it
+    are dropped, and the document walk is skipped entirely when none are left.
     """
+    fill_args = _fill_args(file_bytes, replacements, original_text, digest)
+    if fill_args is None:
+        return file_bytes
     try:
-        doc = docx.Document(io.BytesIO(file_bytes))
-        for p in doc.paragraphs:
-            for key, value in replacements.items():
-                if key in p.text:
-                    for run in p.runs:
-                        if key in run.text:
-                            run.text = run.text.replace(key, str(value))
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    for p in cell.paragraphs:
-                        for key, value in replacements.items():
-                            if key in p.text:
-                                for run in p.runs:
-                                    if key in run.text:
-                                        run.text = run.text.replace(key, str(value))
-        file_stream = io.BytesIO()
-        doc.save(file_stream)
-        file_stream.seek(0)
-        return file_stream.getvalue()
+        return _fill_docx(*fill_args)
     except Exception as e:
         st.error(f"Error replacing placeholders: {e}")
         return None
 
-def clear_session_state_on_upload():
-    """Resets the session state when a new file is uploaded."""
-    keys_to_clear = [
-        "messages", "placeholders", "filled_values", 
-        "current_placeholder_index", "original_doc_bytes", 
-        "original_text", "api_history"
-    ]
-    for key in keys_to_clear:
-        if key in st.session_state:
-            del st.session_state[key]
-    
-    # Re-initialize with the smart system prompt
-    st.session_state.messages = []
-    st.session_state.placeholders = []
-    st.session_state.filled_values = {}
-    st.session_state.current_placeholder_index = 0
-    st.session_state.original_doc_bytes = None  # <-- FIX
-    st.session_state.original_text = ""          # <-- FIX
-    st.session_state.api_history = [
-        {
+def _get_executor():
+    """
+    This session's background worker pool, kept in session state across reruns (a module-level
+    pool would be rebuilt on every rerun). Each session gets its own QUESTION_PREFETCH + 1 workers,
+    enough for its question prefetch window plus the final document build, so its work never
+    queues behind other sessions' requests. Idle workers exit once the session is discarded.
+    """
+    if "executor" not in st.session_state:
+        st.session_state.executor = ThreadPoolExecutor(max_workers=QUESTION_PREFETCH + 1)
+    return st.session_state.executor
+
+def prefetch_filled_doc(file_bytes, replacements, original_text=None, digest=None):
+    """
+    Starts building the filled .docx in the background so it lands in the `_fill_docx` cache.
+    Returns the Future, or None when there is nothing to replace. Errors are not reported here;
+    the regular `replace_placeholders_in_doc` call on the download path surfaces them.
+    """
+    fill_args = _fill_args(file_bytes, replacements, original_text, digest)
+    if fill_args is None:
+        return None
+    return _get_executor().submit(_fill_docx, *fill_args)
+
+def preview_segments(original_text):
+    """
+    Splits `original_text` for the preview, once per upload. Returns (segments, positions):
+    literal text at the even indices of `segments`, each placeholder (italicized, as unfilled)
+    at the odd ones, and `positions` mapping each placeholder to its indices in `segments`.
+    """
+    segments = _PLACEHOLDER_RE.split(original_text)
+    positions = {}
+    for i in range(1, len(segments), 2):
+        positions.setdefault(segments[i], []).append(i)
+        segments[i] = f"_{segments[i]}_"
+    return segments, positions
+
+def fill_preview(segments, positions, ph, value):
+    """
+    Shows `value` in bold wherever `ph` occurs: rewrites only that placeholder's entries of
+    `segments`, in place, and returns the joined preview markdown.
+    """
+    for i in positions.get(ph, ()):
+        segments[i] = f"**{value}**"
+    return "".join(segments)
+
+# Only the system prompt plus the most recent messages (3 turns) are sent to the model,
+# and `api_history` is trimmed to the same window; the chat UI renders `messages` instead.
+# Each chat turn adds 3 messages: the user's answer, our next instruction and the AI's reply.
+API_HISTORY_WINDOW = 9
+
+def _request_messages(api_history, filled_values=None):
+    """
+    The system prompt plus the last API_HISTORY_WINDOW messages of `api_history`.
+    Older turns are replaced by a compact "Already filled" note built from `filled_values`.
+    """
+    system_msg = api_history[0]
+    if filled_values:
+        system_msg = {
             "role": "system",
-            "content": """
+            "content": f"{system_msg['content']}\nAlready filled: {json.dumps(filled_values)}"
+        }
+    return [system_msg] + api_history[1:][-API_HISTORY_WINDOW:]
+
+def get_ai_response(api_history, filled_values=None, response_format=None):
+    """
+    Sends the recent history (see `_request_messages`) to Cohere and returns the reply text.
+    `response_format` is passed through when given (e.g. {"type": "json_object"}).
+    """
+    messages = _request_messages(api_history, filled_values)
+    # The raw response keeps the SDK's auth, retries and timeouts but skips building
+    # the pydantic response models; only the reply text is needed here.
+    extra_args = {"response_format": response_format} if response_format else {}
+    response = client.chat.completions.with_raw_response.create(
+        messages=messages,
+        model=COHERE_MODEL,
+        **extra_args
+    )
+    return json.loads(response.content)["choices"][0]["message"]["content"]
+
+def stream_ai_response(api_history, filled_values=None):
+    """Like `get_ai_response`, but yields the reply text piece by piece as it is generated (for `st.write_stream`)."""
+    stream = client.chat.completions.create(
+        messages=_request_messages(api_history, filled_values),
+        model=COHERE_MODEL,
+        stream=True
+    )
+    for chunk in stream:
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
+
+# Questions for the next few placeholders are requested concurrently and ahead of time,
+# so a chat turn usually just picks up a reply that has already arrived.
+QUESTION_PREFETCH = 3
+
+# Placeholder names are split into words: "{ClientName}", "[client_name]", "<DATE OF AGREEMENT>".
+_PH_DELIMS_RE = re.compile(r"[{}\[\]<>%$_]+")
+_PH_NAME_RE = re.compile(r"[A-Za-z0-9 -]+")
+_PH_WORD_RE = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+")
+HUMANIZE_MAX_WORDS = 4
+
+def humanize(ph):
+    """
+    A plain question built from the placeholder's own name, e.g. '{ClientName}' -> 'What is the client name?'.
+    Returns None when the name isn't descriptive enough (a single word, a long phrase,
+    or anything but letters and digits), leaving that placeholder to the AI.
+    """
+    name = _PH_DELIMS_RE.sub(" ", ph).strip()
+    if not _PH_NAME_RE.fullmatch(name):
+        return None
+    words = _PH_WORD_RE.findall(name)
+    if not 2 <= len(words) <= HUMANIZE_MAX_WORDS:
+        return None
+    return f"What is the {' '.join(words).lower()}?"
+
+# Opens the chat when the first question comes from `humanize` rather than the AI.
+_GREETING = "Hi! I'm LegalEase AI, and I'll help you fill in your document. "
+
+def _local_question(index, ph):
+    """`humanize(ph)`, with the chat's greeting in front for the first placeholder; None if it can't."""
+    question = humanize(ph)
+    if question and index == 0:
+        return _GREETING + question
+    return question
+
+def _question_prompt(index, ph):
+    """The instruction asking the AI for the question about the placeholder at `index`."""
+    if index == 0:
+        # This prompt tells the AI (which has the system prompt) to start the job.
+        return f"Hello! I've uploaded a document. Here is the first placeholder: '{ph}'. Please ask me the first question."
+    return f"The next placeholder is: '{ph}'. Please ask me the question for this one."
+
+def prefetch_questions(placeholders, start, api_history, prefetched):
+    """
+    Submits question requests for placeholders[start:start + QUESTION_PREFETCH] not already in `prefetched`.
+    Each request carries only the system prompt and its own instruction, so they can run concurrently.
+    """
+    executor = _get_executor()
+    for index in range(start, min(start + QUESTION_PREFETCH, len(placeholders))):
+        if index not in prefetched and humanize(placeholders[index]) is None:
+            history = [api_history[0], {"role": "user", "content": _question_prompt(index, placeholders[index])}]
+            prefetched[index] = executor.submit(get_ai_response, history)
+
+def get_question(placeholders, index, api_history, prefetched):
+    """Returns the AI's question for placeholders[index] and tops up the prefetch window behind it."""
+    prefetch_questions(placeholders, index, api_history, prefetched)
+    return prefetched.pop(index).result()
+
+def generate_questions(api_history, placeholders):
+    """
+    The questions for every placeholder, in placeholder order: `humanize` where it can,
+    and the rest from the AI in a single request (none at all if `humanize` covers them all).
+    Returns None if the request fails or the reply doesn't fit,
+    in which case the chat falls back to per-placeholder requests (`get_question`).
+    """
+    questions = [_local_question(i, ph) for i, ph in enumerate(placeholders)]
+    pending = [i for i, q in enumerate(questions) if q is None]
+    if not pending:
+        return questions
+
+    # Only the AI's questions are listed, so say whether the first of them also opens the chat.
+    opening = (
+        "The first of these is the first question of our chat, so start it with a short, friendly greeting, "
+        "and start every other question "
+        if pending[0] == 0 else
+        "The chat is already under way, so start every question "
+    )
+    prompt = (
+        f"Here are placeholders from my document, in order: {json.dumps([placeholders[i] for i in pending])}. "
+        'Reply with a JSON object {"questions": [...]} holding exactly one question per placeholder, in the same order. '
+        + opening + "with a brief confirmation of my previous answer (e.g. \"Got it.\", \"Perfect.\")."
+    )
+    try:
+        reply = get_ai_response(
+            [api_history[0], {"role": "user", "content": prompt}], response_format={"type": "json_object"}
+        )
+        ai_questions = json.loads(reply)["questions"]
+    except Exception:
+        return None
+    if (not isinstance(ai_questions, list) or len(ai_questions) != len(pending)
+            or not all(isinstance(q, str) and q for q in ai_questions)):
+        return None
+    for i, q in zip(pending, ai_questions):
+        questions[i] = q
+    return questions
+
+def ask_question(index):
+    """The question for placeholder `index`: from the batch reply when there is one, else built or fetched on demand."""
+    if st.session_state.questions:
+        return st.session_state.questions[index]
+    placeholders = st.session_state.placeholders
+    api_history = st.session_state.api_history
+    prefetched = st.session_state.prefetched_questions
+    question = _local_question(index, placeholders[index])
+    if question is None:
+        return get_question(placeholders, index, api_history, prefetched)
+    # No request needed for this one, but keep the AI's next questions coming while the user types.
+    prefetch_questions(placeholders, index + 1, api_history, prefetched)
+    return question
+
+# The smart system prompt every session starts with.
+SYSTEM_PROMPT = {
+    "role": "system",
+    "content": """
             You are a helpful and friendly assistant named 'LegalEase AI'. 
             Your goal is to help a user fill in a document. 
             I will give you placeholders one by one, like '{ClientName}' or '[DocumentDate]'.
@@ -130,35 +585,34 @@ def clear_session_state_on_upload():
             3.  When the user answers, confirm briefly (e.g., "Got it.", "Perfect.") and then immediately ask the question for the *next* placeholder I give you.
             4.  Keep your questions clear and concise.
             """
-        }
-    ]
+}
+
+def default_session_state():
+    """Fresh values for every per-upload session key (new containers each call)."""
+    return {
+        "messages": [],
+        "placeholders": [],
+        "filled_values": {},
+        "current_placeholder_index": 0,
+        "doc_digest": None,  # sha256 of the analysed upload; its bytes stay with the file uploader
+        "original_text": "",
+        "preview_segments": [],  # Rendered preview pieces (see preview_segments)
+        "preview_positions": {}, # placeholder -> its indices in preview_segments
+        "preview_text": "",
+        "prefetched_questions": {},  # placeholder index -> Future of the AI's question
+        "questions": None,           # All questions from one batch request, when it worked
+        "api_history": [dict(SYSTEM_PROMPT)],
+    }
+
+def clear_session_state_on_upload():
+    """Resets the session state when a new file is uploaded."""
+    # Assigning every key overwrites the old values, so no separate delete pass is needed.
+    st.session_state.update(default_session_state())
 
 # --- Session State Initialization ---
-# This block now explicitly initializes all keys on the first run.
+# This block explicitly initializes all keys on the first run.
 if "messages" not in st.session_state:
-    st.session_state.messages = []
-    st.session_state.placeholders = []
-    st.session_state.filled_values = {}
-    st.session_state.current_placeholder_index = 0
-    st.session_state.original_doc_bytes = None  # <-- FIX
-    st.session_state.original_text = ""          # <-- FIX
-    st.session_state.api_history = [
-        {
-            "role": "system",
-            "content": """
-            You are a helpful and friendly assistant named 'LegalEase AI'. 
-            Your goal is to help a user fill in a document. 
-            I will give you placeholders one by one, like '{ClientName}' or '[DocumentDate]'.
-            Your job is to ask the user for the information to fill these placeholders.
-            
-            RULES:
-            1.  Be conversational and natural. For example, instead of "What is {ClientName}?", ask "Who is the client for this agreement?" or "What's the client's full name?".
-            2.  Ask for only ONE piece of information at a time.
-            3.  When the user answers, confirm briefly (e.g., "Got it.", "Perfect.") and then immediately ask the question for the *next* placeholder I give you.
-            4.  Keep your questions clear and concise.
-            """
-        }
-    ]
+    st.session_state.update(default_session_state())
 
 
 # --- Main App UI ---
@@ -177,20 +631,24 @@ with col1:
         on_change=clear_session_state_on_upload # Reset session on new file
     )
 
-    if uploaded_file is not None and st.session_state.original_doc_bytes is None:
+    if uploaded_file is not None and st.session_state.doc_digest is None:
         with st.spinner("Analyzing document..."):
             file_bytes = uploaded_file.getvalue()
-            st.session_state.original_doc_bytes = file_bytes
-            text, placeholders = extract_text_and_placeholders(file_bytes)
+            st.session_state.doc_digest = _doc_digest(file_bytes)
+            text, placeholders = extract_text_and_placeholders(file_bytes, st.session_state.doc_digest)
             
             if text is None:
-                st.session_state.original_doc_bytes = None
+                st.session_state.doc_digest = None
             elif not placeholders:
                 st.warning("📄 No placeholders (like {Name} or [Date]) found.")
-                st.session_state.original_doc_bytes = None
+                st.session_state.doc_digest = None
             else:
                 st.session_state.original_text = text
                 st.session_state.placeholders = placeholders
+                segments, positions = preview_segments(text)
+                st.session_state.preview_segments = segments
+                st.session_state.preview_positions = positions
+                st.session_state.preview_text = "".join(segments)
                 st.success(f"Found {len(placeholders)} placeholders!")
                 
                 with st.expander("Click to see all found placeholders"):
@@ -198,19 +656,17 @@ with col1:
                 
                 # --- SMART KICK-OFF PROMPT ---
                 first_ph = st.session_state.placeholders[0]
-                # This prompt tells the AI (which has the system prompt) to start the job.
-                prompt_to_ai = f"Hello! I've uploaded a document. Here is the first placeholder: '{first_ph}'. Please ask me the first question."
+                prompt_to_ai = _question_prompt(0, first_ph)
                 
                 try:
                     # Add our instruction to the AI's history
                     st.session_state.api_history.append({"role": "user", "content": prompt_to_ai})
                     
-                    response = client.chat.completions.create(
-                        messages=st.session_state.api_history,
-                        model=COHERE_MODEL
+                    # One request for every question, so the chat itself needs no further round-trips.
+                    st.session_state.questions = generate_questions(
+                        st.session_state.api_history, st.session_state.placeholders
                     )
-                    
-                    response_text = response.choices[0].message.content
+                    response_text = ask_question(0)
                     
                     # Add AI's response to both histories
                     st.session_state.api_history.append({"role": "assistant", "content": response_text})
@@ -220,7 +676,7 @@ with col1:
                     st.error(f"Error with Cohere API: {e}")
 
     # --- Conversational Chat ---
-    if st.session_state.original_doc_bytes is not None and st.session_state.placeholders:
+    if st.session_state.doc_digest is not None and st.session_state.placeholders:
         st.markdown("---")
         st.subheader("💬 Chat to Fill")
 
@@ -231,81 +687,101 @@ with col1:
 
         # Chat input
         if prompt := st.chat_input("Your answer..."):
-            # Add user's answer to both histories
-            st.session_state.messages.append({"role": "user", "content": prompt})
-            st.session_state.api_history.append({"role": "user", "content": prompt})
+            # Bound once: each st.session_state access goes through the proxy.
+            placeholders = st.session_state.placeholders
+            filled = st.session_state.filled_values
+            hist = st.session_state.api_history
+            current_index = st.session_state.current_placeholder_index
+
+            # This turn's messages are collected locally and written to
+            # session state once, after the exchange (see below).
+            pending_msgs = [{"role": "user", "content": prompt}]
+            pending_api = [{"role": "user", "content": prompt}]
 
             with st.chat_message("assistant"):
                 with st.spinner("Thinking..."):
                     try:
                         # Store the value
-                        current_index = st.session_state.current_placeholder_index
-                        current_ph = st.session_state.placeholders[current_index]
-                        st.session_state.filled_values[current_ph] = prompt
+                        current_ph = placeholders[current_index]
+                        filled[current_ph] = prompt # st.chat_input returns str; the fill relies on it
+                        # Stored, so plain reruns render it without rebuilding.
+                        st.session_state.preview_text = fill_preview(
+                            st.session_state.preview_segments, st.session_state.preview_positions,
+                            current_ph, prompt
+                        )
                         
                         # Move to the next placeholder
-                        st.session_state.current_placeholder_index += 1
-                        next_index = st.session_state.current_placeholder_index
+                        next_index = current_index + 1
+                        st.session_state.current_placeholder_index = next_index
                         
-                        if next_index < len(st.session_state.placeholders):
+                        final_doc_future = None
+                        if next_index < len(placeholders):
                             # --- SMART NEXT-QUESTION PROMPT ---
-                            next_ph = st.session_state.placeholders[next_index]
-                            ai_prompt = f"The next placeholder is: '{next_ph}'. Please ask me the question for this one."
+                            next_ph = placeholders[next_index]
+                            ai_prompt = _question_prompt(next_index, next_ph)
                         else:
                             # --- SMART FINAL PROMPT ---
                             ai_prompt = "That was the last placeholder! Please provide a brief, friendly message letting me know I'm all done and can review the document on the right."
+                            # Build the final document while the closing message is generated.
+                            final_doc_future = prefetch_filled_doc(
+                                uploaded_file.getvalue(),
+                                filled,
+                                original_text=st.session_state.original_text,
+                                digest=st.session_state.doc_digest
+                            )
 
                         # Add our new instruction to the AI's history
-                        st.session_state.api_history.append({"role": "user", "content": ai_prompt})
-                        
-                        response = client.chat.completions.create(
-                            messages=st.session_state.api_history,
-                            model=COHERE_MODEL
-                        )
+                        pending_api.append({"role": "user", "content": ai_prompt})
                         
-                        response_text = response.choices[0].message.content
+                        if next_index < len(placeholders):
+                            # Already known from the batch request, or prefetched while the user was typing.
+                            response_text = ask_question(next_index)
+                            st.markdown(response_text)
+                        else:
+                            # Shown token by token while it is generated.
+                            response_text = st.write_stream(stream_ai_response(hist + pending_api, filled))
                         
                         # Add AI's response to both histories
-                        st.session_state.api_history.append({"role": "assistant", "content": response_text})
-                        st.session_state.messages.append({"role": "assistant", "content": response_text})
+                        pending_api.append({"role": "assistant", "content": response_text})
+                        pending_msgs.append({"role": "assistant", "content": response_text})
                         
-                        st.markdown(response_text)
+                        if final_doc_future is not None:
+                            final_doc_future.exception() # Wait; the download path reports any error
                     
                     except Exception as e:
                         st.error(f"Error with Cohere API: {e}")
-                        st.session_state.current_placeholder_index -= 1 # Roll back on error
+                        st.session_state.current_placeholder_index = current_index # Roll back on error
+
+            st.session_state.messages.extend(pending_msgs)
+            hist.extend(pending_api)
+            del hist[1:-API_HISTORY_WINDOW] # Keep the system prompt + window
 
 # --- Column 2: Review & Download (No changes needed) ---
 with col2:
     st.header("2. Review & Download")
     
-    if st.session_state.original_doc_bytes is None:
+    if st.session_state.doc_digest is None:
         st.info("Upload a document on the left to see a preview here.")
     else:
         with st.container(height=500, border=True):
             st.subheader("Live Preview")
-            preview_text = st.session_state.original_text
-            
-            for ph, val in st.session_state.filled_values.items():
-                preview_text = preview_text.replace(ph, f"**{val}**") # Bold filled values
-            
-            for ph in st.session_state.placeholders:
-                if ph not in st.session_state.filled_values:
-                    preview_text = preview_text.replace(ph, f"_{ph}_") # Italicize unfilled
-
-            st.markdown(preview_text)
+            st.markdown(st.session_state.preview_text)
         
         st.markdown("---")
 
-        all_filled = len(st.session_state.filled_values) == len(st.session_state.placeholders)
+        placeholders = st.session_state.placeholders
+        filled = st.session_state.filled_values
+        all_filled = len(filled) == len(placeholders)
         
-        if all_filled and st.session_state.placeholders:
+        if all_filled and placeholders:
             st.success("All fields filled! 🎉")
             
             with st.spinner("Generating final document..."):
                 final_doc_bytes = replace_placeholders_in_doc(
-                    st.session_state.original_doc_bytes,
-                    st.session_state.filled_values
+                    uploaded_file.getvalue(),
+                    filled,
+                    original_text=st.session_state.original_text,
+                    digest=st.session_state.doc_digest
                 )
             
             if final_doc_bytes:
@@ -316,56 +792,6 @@ with col2:
                     mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
                     use_container_width=True
                 )
-        elif st.session_state.placeholders:
-            progress = len(st.session_state.filled_values) / len(st.session_state.placeholders)
-            st.progress(progress, text=f"{len(st.session_state.filled_values)} / {len(st.session_state.placeholders)} fields filled")
-
-def replace_placeholders_in_doc(file_bytes, replacements):
-    """Replaces placeholders in the docx file and returns the file bytes."""
-    try:
-        doc = docx.Document(io.BytesIO(file_bytes))
-        
-        def replace_in_paragraph(paragraph):
-            """Replace placeholders in a paragraph by working with full text."""
-            # Get the full paragraph text
-            full_text = paragraph.text
-            
-            # Check if any placeholder exists in this paragraph
-            needs_replacement = any(key in full_text for key in replacements.keys())
-            
-            if needs_replacement:
-                # Replace all placeholders in the full text
-                new_text = full_text
-                for key, value in replacements.items():
-                    new_text = new_text.replace(key, str(value))
-                
-                # Clear all runs in the paragraph
-                for run in paragraph.runs:
-                    run.text = ""
-                
-                # Add the new text as a single run (preserves first run's formatting)
-                if paragraph.runs:
-                    paragraph.runs[0].text = new_text
-                else:
-                    paragraph.add_run(new_text)
-        
-        # Process main body paragraphs
-        for paragraph in doc.paragraphs:
-            replace_in_paragraph(paragraph)
-        
-        # Process table cells
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    for paragraph in cell.paragraphs:
-                        replace_in_paragraph(paragraph)
-        
-        # Save to bytes
-        file_stream = io.BytesIO()
-        doc.save(file_stream)
-        file_stream.seek(0)
-        return file_stream.getvalue()
-    
-    except Exception as e:
-        st.error(f"Error replacing placeholders: {e}")
-        return None
+        elif placeholders:
+            progress = len(filled) / len(placeholders)
+            st.progress(progress, text=f"{len(filled)} / {len(placeholders)} fields filled")